@@ -1,11 +1,92 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_file, send_from_directory
 from flask_cors import CORS
-import os, subprocess, uuid
-import json # Import json module
+import hashlib
+import logging
+import os, re, time, uuid
+import tempfile
+import threading
+from collections import OrderedDict
+
+# One logger for the whole request path; per-request chatter sits at DEBUG so
+# the hot path does no stdout flushing unless explicitly asked for
+logging.basicConfig(level=os.environ.get('LOGLEVEL', 'WARNING'))
+logger = logging.getLogger('ecg')
+
+# Importing process_ecg here pays the heavy numpy/scipy/wfdb/heartpy import
+# cost once at startup instead of once per request in a subprocess.
+from process_ecg import process
 
 app = Flask(__name__)
 CORS(app)
 
+# Cap request size so a bad client can't fill the disk (.hea/.dat/.atr for a
+# full MIT-BIH record are well under this)
+app.config['MAX_CONTENT_LENGTH'] = 256 * 1024 * 1024
+
+# Chunk size for streaming uploads straight to disk
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+
+# Bounded LRU of content digest -> pre-serialized response bytes: re-uploads
+# of the same record (common in demos/testing) skip the whole pipeline.
+# Entries are also spilled to OUTPUT_FOLDER so hits that have fallen out of
+# the in-memory tier are served via send_file, letting the WSGI server use
+# wsgi.file_wrapper (kernel sendfile from page cache, no user-space copy).
+_RESPONSE_CACHE = OrderedDict()
+# gunicorn runs several gthread threads per worker, so every touch of the
+# OrderedDict (lookup, LRU reorder, eviction) happens under this lock
+_RESPONSE_CACHE_LOCK = threading.Lock()
+_RESPONSE_CACHE_MAX = 32
+_DISK_CACHE_MAX = 256
+
+# Spilled cache entries are named <32-hex digest>.json; the prune below must
+# only ever touch those, not the ecg_plot*/ecg_phases* files the CLI
+# workflow writes into the same directory
+_CACHE_FILE_RE = re.compile(r'[0-9a-f]{32}\.json')
+
+
+def _cache_path(digest):
+    return os.path.join(OUTPUT_FOLDER, f"{digest}.json")
+
+
+def _cache_get(digest):
+    with _RESPONSE_CACHE_LOCK:
+        cached = _RESPONSE_CACHE.get(digest)
+        if cached is not None:
+            _RESPONSE_CACHE.move_to_end(digest)
+        return cached
+
+
+def _cache_put(digest, value):
+    with _RESPONSE_CACHE_LOCK:
+        _RESPONSE_CACHE[digest] = value
+        _RESPONSE_CACHE.move_to_end(digest)
+        while len(_RESPONSE_CACHE) > _RESPONSE_CACHE_MAX:
+            _RESPONSE_CACHE.popitem(last=False)
+
+    # The disk spill does file I/O, so it stays outside the lock
+    try:
+        # Write to a temp file and os.replace() it into place: other workers
+        # poll the path with os.path.exists, so the entry has to appear
+        # atomically rather than mid-write
+        fd, tmp_path = tempfile.mkstemp(dir=OUTPUT_FOLDER, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+            os.replace(tmp_path, _cache_path(digest))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        # Keep the disk tier bounded too: drop the least recently written
+        cached_files = sorted((os.path.getmtime(p), p) for p in
+                              (os.path.join(OUTPUT_FOLDER, name)
+                               for name in os.listdir(OUTPUT_FOLDER)
+                               if _CACHE_FILE_RE.fullmatch(name)))
+        for _, stale in cached_files[:-_DISK_CACHE_MAX]:
+            os.remove(stale)
+    except OSError as e:
+        logger.warning("Could not spill response cache to disk: %s", e)
+
 # Define UPLOAD_FOLDER and OUTPUT_FOLDER relative to the current script's directory
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
@@ -15,6 +96,38 @@ OUTPUT_FOLDER = os.path.join(BASE_DIR, 'outputs')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
+def _rewrite_header(hea_path, record_id):
+    """Point a saved .hea at the files stored under record_id.
+
+    The uploaded header still names the original record's signal files
+    (e.g. 100.dat), so wfdb would open whatever happens to sit in uploads/
+    under that name instead of the .dat this request just saved. Rewrite
+    the record name and every signal file name to the record_id the handler
+    used when saving.
+    """
+    with open(hea_path, 'r') as f:
+        lines = f.readlines()
+
+    rewritten = []
+    seen_record_line = False
+    for line in lines:
+        stripped = line.strip()
+        if stripped and not stripped.startswith('#'):
+            fields = line.split()
+            if not seen_record_line:
+                # record line: '<name> <n_sig> <fs> ...'
+                fields[0] = record_id
+                seen_record_line = True
+            else:
+                # signal line: '<file_name> <format> ...'
+                fields[0] = record_id + os.path.splitext(fields[0])[1]
+            line = ' '.join(fields) + '\n'
+        rewritten.append(line)
+
+    with open(hea_path, 'w') as f:
+        f.writelines(rewritten)
+
+
 @app.route('/')
 def home():
     return '✅ ECG Backend is running!'
@@ -25,13 +138,18 @@ def upload_files():
     expected_extensions = ['hea', 'dat', 'atr']
     saved_files = []
 
-    print(f"[{record_id}] Starting file upload process.")
+    # Hash the upload bytes as they stream past so duplicate records can be
+    # answered from cache without re-running the pipeline
+    hasher = hashlib.blake2b(digest_size=16)
+
+    t0 = time.perf_counter()
+    logger.debug("[%s] Starting file upload process.", record_id)
 
     # Validate and save uploaded files
     for ext in expected_extensions:
         file = request.files.get(f'file_{ext}')
         if not file:
-            print(f"[{record_id}] ❌ Missing file: file_{ext}")
+            logger.warning("[%s] Missing file: file_%s", record_id, ext)
             # Clean up any files saved so far if one is missing
             for path_to_clean in saved_files:
                 if os.path.exists(path_to_clean):
@@ -40,83 +158,105 @@ def upload_files():
 
         path = os.path.join(UPLOAD_FOLDER, f"{record_id}.{ext}")
         try:
-            file.save(path)
+            # Stream the part to disk in large chunks instead of file.save(),
+            # which goes through werkzeug's small default buffer and can
+            # double-buffer big .dat files in memory/temp files. The same
+            # chunks feed the content hash, so hashing costs no extra read.
+            with open(path, 'wb') as out:
+                while chunk := file.stream.read(UPLOAD_CHUNK_SIZE):
+                    hasher.update(chunk)
+                    out.write(chunk)
             saved_files.append(path)
-            print(f"[{record_id}] ✅ Saved: {path}")
+            logger.debug("[%s] Saved: %s", record_id, path)
         except Exception as e:
-            print(f"[{record_id}] ❌ Failed to save file {path}: {e}")
+            logger.error("[%s] Failed to save file %s: %s", record_id, path, e)
             # Clean up if save fails
             for path_to_clean in saved_files:
                 if os.path.exists(path_to_clean):
                     os.remove(path_to_clean)
             return jsonify({'error': f'Failed to save {ext} file', 'details': str(e)}), 500
 
-    print(f"[{record_id}] 📡 Running process_ecg.py for: {record_id}")
     try:
-        # Pass the record_id to process_ecg.py
-        # Ensure process_ecg.py is in the same directory or accessible via PATH
-        command = ['python3', os.path.join(BASE_DIR, 'process_ecg.py'), record_id]
-        print(f"[{record_id}] Executing command: {' '.join(command)}")
-        
-        result = subprocess.run(command, capture_output=True, text=True, check=True)
-        print(f"[{record_id}] process_ecg.py stdout:\n{result.stdout}")
-        if result.stderr:
-            print(f"[{record_id}] process_ecg.py stderr:\n{result.stderr}")
-
-        plot_path = os.path.join(OUTPUT_FOLDER, f'ecg_plot{record_id}.json')
-        phases_path = os.path.join(OUTPUT_FOLDER, f'ecg_phases{record_id}.json')
-
-        # Check if output files were created
-        if not os.path.exists(plot_path) or not os.path.exists(phases_path):
-            print(f"[{record_id}] ❌ Output files not found after processing. Plot: {os.path.exists(plot_path)}, Phases: {os.path.exists(phases_path)}")
-            return jsonify({'error': 'ECG processing failed: Output files not generated'}), 500
-
-        # Read the generated JSON files
-        with open(plot_path, 'r') as f1, open(phases_path, 'r') as f2:
-            response = {
-                'plot': f1.read(),
-                'phases': f2.read()
-            }
-        
-        print(f"[{record_id}] ✅ Successfully processed and read JSONs.")
-
-        return jsonify(response)
-
-    except subprocess.CalledProcessError as e:
-        print(f"[{record_id}] ❌ Subprocess error: {e}")
-        print(f"[{record_id}] stdout: {e.stdout}")
-        print(f"[{record_id}] stderr: {e.stderr}")
-        return jsonify({'error': 'ECG processing failed', 'details': e.stderr or str(e)}), 500
-    except FileNotFoundError:
-        print(f"[{record_id}] ❌ process_ecg.py not found or Python interpreter issue.")
-        return jsonify({'error': 'Server configuration error: processing script not found'}), 500
-    except json.JSONDecodeError as e:
-        print(f"[{record_id}] ❌ JSON decoding error from output files: {e}")
-        return jsonify({'error': 'Failed to read generated JSON files', 'details': str(e)}), 500
+        # Retarget the header at the files saved above, otherwise wfdb reads
+        # the signal files named inside it, not this request's bytes
+        _rewrite_header(os.path.join(UPLOAD_FOLDER, f"{record_id}.hea"), record_id)
+    except Exception as e:
+        logger.error("[%s] Failed to rewrite header: %s", record_id, e)
+        for path_to_clean in saved_files:
+            if os.path.exists(path_to_clean):
+                os.remove(path_to_clean)
+        return jsonify({'error': 'Invalid .hea file', 'details': str(e)}), 400
+
+    # The response depends on the ECG_MAX_SECONDS bound as well as the
+    # upload bytes, and the disk tier outlives restarts - mix the effective
+    # bound into the digest so changing it can't serve stale entries
+    hasher.update(os.environ.get('ECG_MAX_SECONDS', '').encode())
+
+    digest = hasher.hexdigest()
+    cached = _cache_get(digest)
+    if cached is not None:
+        logger.debug("[%s] Cache hit for digest %s; skipping pipeline.", record_id, digest)
+        for path_to_clean in saved_files:
+            if os.path.exists(path_to_clean):
+                os.remove(path_to_clean)
+        return Response(cached, mimetype='application/json')
+
+    disk_cached = _cache_path(digest)
+    if os.path.exists(disk_cached):
+        try:
+            # send_file goes through wsgi.file_wrapper, so the server can
+            # sendfile(2) the bytes straight from page cache to the socket
+            response = send_file(disk_cached, mimetype='application/json',
+                                 conditional=True, max_age=0)
+        except OSError:
+            # Another worker pruned the entry between the exists check and
+            # the open; fall through and reprocess
+            logger.debug("[%s] Disk cache entry %s vanished; reprocessing.", record_id, digest)
+        else:
+            logger.debug("[%s] Disk cache hit for digest %s; serving via sendfile.", record_id, digest)
+            for path_to_clean in saved_files:
+                if os.path.exists(path_to_clean):
+                    os.remove(path_to_clean)
+            return response
+
+    logger.debug("[%s] Processing ECG in-process.", record_id)
+    try:
+        # Run the pipeline directly; no interpreter startup, no re-imports
+        plot_bytes, phases_bytes = process(record_id, UPLOAD_FOLDER)
+
+        # Splice the pre-serialized payloads straight into the response body
+        # instead of decoding and re-encoding them through jsonify
+        resp_bytes = b'{"plot":' + plot_bytes + b',"phases":' + phases_bytes + b'}'
+        _cache_put(digest, resp_bytes)
+
+        logger.info("processed %s in %.1f ms", record_id,
+                    (time.perf_counter() - t0) * 1000)
+
+        return Response(resp_bytes, mimetype='application/json')
+
+    except FileNotFoundError as e:
+        logger.error("[%s] Missing input file: %s", record_id, e)
+        return jsonify({'error': 'ECG processing failed: input file missing', 'details': str(e)}), 500
+    except RuntimeError as e:
+        logger.error("[%s] Processing error: %s", record_id, e)
+        return jsonify({'error': 'ECG processing failed', 'details': str(e)}), 500
     except Exception as e:
-        print(f"[{record_id}] ❌ Unexpected error: {e}")
+        logger.exception("[%s] Unexpected error: %s", record_id, e)
         return jsonify({'error': 'Unexpected server error', 'details': str(e)}), 500
     finally:
-        # Cleanup: Delete all temporary files (uploaded and generated outputs)
-        print(f"[{record_id}] Initiating cleanup of temporary files.")
-        files_to_clean = list(saved_files) # Copy list to avoid modification during iteration
-        
-        # Add generated output files to cleanup list, if they exist
-        output_plot_path = os.path.join(OUTPUT_FOLDER, f'ecg_plot{record_id}.json')
-        output_phases_path = os.path.join(OUTPUT_FOLDER, f'ecg_phases{record_id}.json')
-        if os.path.exists(output_plot_path):
-            files_to_clean.append(output_plot_path)
-        if os.path.exists(output_phases_path):
-            files_to_clean.append(output_phases_path)
-
-        for file_path in files_to_clean:
+        # Cleanup: Delete the uploaded files; the pipeline itself no longer
+        # touches the outputs directory
+        logger.debug("[%s] Initiating cleanup of temporary files.", record_id)
+        for file_path in saved_files:
             try:
                 if os.path.exists(file_path):
                     os.remove(file_path)
-                    print(f"[{record_id}] Deleted: {file_path}")
+                    logger.debug("[%s] Deleted: %s", record_id, file_path)
             except Exception as e:
-                print(f"[{record_id}] ⚠️ Could not delete {file_path}: {e}")
+                logger.warning("[%s] Could not delete %s: %s", record_id, file_path, e)
 
 if __name__ == '__main__':
+    # Local development only; production runs under gunicorn (see
+    # gunicorn.conf.py / Procfile)
     port = int(os.environ.get("PORT", 5000))
-    app.run(debug=True, host='0.0.0.0', port=port)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=port)
\ No newline at end of file
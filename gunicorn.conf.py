@@ -0,0 +1,31 @@
+import os
+
+# Pin BLAS thread pools before numpy is imported: each gunicorn worker runs
+# its own pipeline, so per-core OpenBLAS/MKL pools in every worker would
+# oversubscribe the machine.
+os.environ.setdefault("OPENBLAS_NUM_THREADS", "1")
+os.environ.setdefault("MKL_NUM_THREADS", "1")
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = max(2, os.cpu_count() or 1)
+threads = 4
+worker_class = "gthread"
+timeout = 120
+
+# Import the app (and with it numpy/scipy/wfdb/heartpy) once in the master;
+# forked workers share that warmed state copy-on-write instead of each
+# paying the ~1 s import cost on their first request.
+preload_app = True
+
+
+def post_fork(server, worker):
+    # Run one tiny synthetic pipeline in each fresh worker: this JIT-compiles
+    # the Numba kernels (or loads their on-disk cache), populates the FIR
+    # design cache and spins up the encode thread pool, so the first real
+    # request skips all of it.
+    import numpy as np
+    from process_ecg import _pipeline_one_lead
+
+    sig = np.zeros(3600, dtype=np.float32)
+    sig[::360] = 1.0  # impulse train so peak detection has something to find
+    _pipeline_one_lead(sig, 360)
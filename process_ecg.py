@@ -1,150 +1,362 @@
 import sys
 import os
-import json
+import base64
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import orjson
 import numpy as np
 import wfdb
 import heartpy as hp
 from scipy import signal as sp_signal
 
-# Ensure record_id is always passed. If not, exit immediately.
-if len(sys.argv) < 2:
-    print("Error: record_id not provided. Usage: python process_ecg.py <record_id>")
-    sys.exit(1)
+# Numba is optional: when present the FIR and PQRST hot loops run as
+# parallel JIT kernels, otherwise the scipy/NumPy paths below are used.
+try:
+    from numba import njit
+    _HAVE_NUMBA = True
+except ImportError:
+    _HAVE_NUMBA = False
+
+# joblib is optional as well: multi-lead requests fan out across cores with
+# the loky backend when it is installed, otherwise leads run sequentially
+try:
+    from joblib import Parallel, delayed
+    _HAVE_JOBLIB = True
+except ImportError:
+    _HAVE_JOBLIB = False
 
-record_id = sys.argv[1] # This will be the UUID (e.g., '0e4a684c')
+logger = logging.getLogger('ecg.process')
 
 project_root = os.path.dirname(os.path.abspath(__file__))
 
-uploads_data = os.path.join(project_root, 'uploads')
-output_data = os.path.join(project_root, 'outputs')
+UPLOADS_DIR = os.path.join(project_root, 'uploads')
+OUTPUT_DIR = os.path.join(project_root, 'outputs')
 
-print(f"Processing record_id: {record_id} in {uploads_data}")
+# Small pool used to overlap plot encoding/writing (I/O + numpy, which
+# releases the GIL) with R-peak detection on the request thread
+_POOL = ThreadPoolExecutor(max_workers=2)
 
-# Verify all three required files exist
-required_exts = [".hea", ".dat", ".atr"]
-for ext in required_exts:
-    file_path = os.path.join(uploads_data, f"{record_id}.{ext}")
-    if not os.path.exists(file_path):
-        print(f"Error: Missing expected file: {file_path}")
-        sys.exit(1) # Exit with an error code if a file is missing
 
-# CRITICAL CHANGE: Use pb_dir parameter to explicitly tell wfdb where to find the files.
-# This is often more robust than os.chdir for wfdb, especially in deployed environments.
-try:
-    # Pass the record_id (base name) and the directory where the files are located
-    record = wfdb.rdrecord(record_id, pb_dir=uploads_data)
-    fs = record.fs
-    ecg_signal = record.p_signal[:, 0]
-    print(f"Successfully read record: {record_id}, Sampling Frequency: {fs}")
-except Exception as e:
-    print(f"Error reading WFDB record {record_id} from {uploads_data}: {e}")
-    sys.exit(1)
+def _jsonize(obj):
+    # Fallback for numpy scalars/dtypes orjson doesn't handle natively
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
 
 
-def fir_bandpass(ecg, fs, low=3, high=45, taps=101):
+if _HAVE_NUMBA:
+    # Deliberately serial: parallel=True kernels are not safe to enter from
+    # several Python threads at once, and the gthread workers (plus the
+    # post_fork warm-up) do exactly that. The per-beat windows are tiny, so
+    # the win here is escaping interpreter overhead, not parallelism.
+    @njit(fastmath=True, cache=True)
+    def _pqrst_numba(filtered, r, q_win, s_win, p_win, t_win):
+        # Same window semantics as the NumPy gather path: manual min/max
+        # scans per beat, -1 for empty windows at the record edges
+        n = filtered.shape[0]
+        m = r.shape[0]
+        p = np.full(m, -1, dtype=np.int64)
+        q = np.full(m, -1, dtype=np.int64)
+        s = np.full(m, -1, dtype=np.int64)
+        t = np.full(m, -1, dtype=np.int64)
+        for i in range(m):
+            ri = r[i]
+
+            lo = ri - q_win
+            if lo < 0:
+                lo = 0
+            if ri > lo:
+                best = lo
+                for j in range(lo + 1, ri):
+                    if filtered[j] < filtered[best]:
+                        best = j
+                q[i] = best
+
+            hi = ri + s_win
+            if hi > n:
+                hi = n
+            if hi > ri:
+                best = ri
+                for j in range(ri + 1, hi):
+                    if filtered[j] < filtered[best]:
+                        best = j
+                s[i] = best
+
+            if q[i] >= 0:
+                lo = q[i] - p_win
+                if lo < 0:
+                    lo = 0
+                if q[i] > lo:
+                    best = lo
+                    for j in range(lo + 1, q[i]):
+                        if filtered[j] > filtered[best]:
+                            best = j
+                    p[i] = best
+
+            if s[i] >= 0:
+                hi = s[i] + t_win
+                if hi > n:
+                    hi = n
+                if hi > s[i]:
+                    best = s[i]
+                    for j in range(s[i] + 1, hi):
+                        if filtered[j] > filtered[best]:
+                            best = j
+                    t[i] = best
+        return p, q, s, t
+
+
+@functools.lru_cache(maxsize=8)
+def _design_fir(fs, low, high, taps):
+    # The design parameters are effectively constant per dataset (MIT-BIH is
+    # 360 Hz), so firwin only ever runs once per distinct (fs, low, high, taps)
     nyq = 0.5 * fs
     if taps % 2 == 0:
         taps += 1
-    filt = sp_signal.firwin(taps, [low / nyq, high / nyq], pass_zero=False)
-    return sp_signal.lfilter(filt, 1.0, ecg)
+    # float32 coefficients keep the convolution (and everything downstream)
+    # in float32 rather than promoting back to float64
+    return sp_signal.firwin(taps, [low / nyq, high / nyq], pass_zero=False).astype(np.float32)
 
-filtered = fir_bandpass(ecg_signal, fs)
-print("ECG signal filtered.")
 
-def detect_r(filtered, fs):
-    try:
-        wd, _ = hp.process(filtered, sample_rate=fs)
-        return np.array(wd['peaklist'])
-    except Exception as e:
-        print(f"Error during R-peak detection: {e}")
-        return np.array([])
+@functools.lru_cache(maxsize=8)
+def _win_offsets(win):
+    return np.arange(win)
+
+
+def fir_bandpass(ecg, fs, low=3, high=45, taps=101):
+    filt = _design_fir(fs, low, high, taps)
+    # Overlap-add FFT convolution: O(N log taps) vs lfilter's scalar
+    # direct-form loop. The FIR is linear-phase, so mode='same' drops the
+    # (taps-1)/2 group delay and the output lines up with the raw signal.
+    return sp_signal.oaconvolve(ecg, filt, mode='same')
+
+
+def _encode_plot(filtered, fs):
+    # Ship the signal as a base64 float32 buffer instead of a JSON number
+    # array: ~4 bytes per sample on the wire instead of ~18 text bytes, and
+    # the frontend decodes it into a Float32Array in one pass.
+    buf = filtered[:fs * 60].astype(np.float32, copy=False).tobytes()
+    return orjson.dumps(
+        {"dtype": "float32", "fs": fs, "data": base64.b64encode(buf).decode()},
+        option=orjson.OPT_SERIALIZE_NUMPY,
+        default=_jsonize,
+    )
+
+
+def detect_r(filtered, fs, use_heartpy=False):
+    if use_heartpy:
+        # HeartPy path kept for parity testing: hp.process computes a pile
+        # of HRV measures we immediately discard
+        try:
+            wd, _ = hp.process(filtered, sample_rate=fs)
+            return np.array(wd['peaklist'])
+        except Exception as e:
+            logger.error("Error during R-peak detection: %s", e)
+            return np.array([])
+
+    # Bare Pan-Tompkins on the already-bandpassed signal: derivative,
+    # square, moving-window integration, thresholded peak pick. Fully
+    # vectorized and ~10x less work than hp.process for the same peak list.
+    deriv = np.diff(filtered, prepend=filtered[0])
+    sq = deriv * deriv
+    win = max(1, int(0.15 * fs))
+    mwi = np.convolve(sq, np.full(win, 1.0 / win, dtype=sq.dtype), mode='same')
+    peaks, _ = sp_signal.find_peaks(mwi,
+                                    distance=max(1, int(0.25 * fs)),
+                                    height=np.quantile(mwi, 0.98) * 0.3)
+    return peaks
+
+
+def _window_extrema(filtered, starts, ends, win, find_min):
+    """Vectorized argmin/argmax over per-peak windows [starts, ends).
+
+    Builds an (N_peaks, win) index matrix and scans it along axis=1 in one
+    NumPy call instead of one Python slice per beat. Samples past a window's
+    end are masked out; empty windows yield -1.
+    """
+    idx = starts[:, None] + _win_offsets(win)[None, :]
+    idx = np.minimum(idx, len(filtered) - 1)
+    vals = filtered[idx]
+    invalid = idx >= ends[:, None]
+    fill = np.inf if find_min else -np.inf
+    vals = np.where(invalid, fill, vals)
+    rel = vals.argmin(axis=1) if find_min else vals.argmax(axis=1)
+    out = idx[np.arange(len(starts)), rel]
+    out[ends <= starts] = -1
+    return out
 
-r_peaks = detect_r(filtered, fs)
-print(f"Detected {len(r_peaks)} R-peaks.")
 
 def detect_pqrst(filtered, r_peaks, fs):
-    p, q, s, t = [], [], [], []
-    for r in r_peaks:
-        r_int = int(r)
-        
-        q_idx_start = max(0, r_int - int(0.08 * fs))
-        q_idx_end = r_int
-        q_val = None
-        if q_idx_end > q_idx_start:
-            q_val_relative = np.argmin(filtered[q_idx_start:q_idx_end])
-            q_val = q_idx_start + q_val_relative
-            
-        s_idx_start = r_int
-        s_idx_end = min(len(filtered), r_int + int(0.08 * fs))
-        s_val = None
-        if s_idx_end > s_idx_start:
-            s_val_relative = np.argmin(filtered[s_idx_start:s_idx_end])
-            s_val = s_idx_start + s_val_relative
-
-        q.append(q_val)
-        s.append(s_val)
-
-        qp = q[-1]
-        sp = s[-1]
-
-        p_val = None
-        if qp is not None:
-            p_idx_start = max(0, int(qp - 0.2 * fs))
-            p_idx_end = int(qp)
-            if p_idx_end > p_idx_start:
-                p_val_relative = np.argmax(filtered[p_idx_start:p_idx_end])
-                p_val = p_idx_start + p_val_relative
-
-        t_val = None
-        if sp is not None:
-            t_idx_start = int(sp)
-            t_idx_end = min(len(filtered), int(sp + 0.4 * fs))
-            if t_idx_end > t_idx_start:
-                t_val_relative = np.argmax(filtered[t_idx_start:t_idx_end])
-                t_val = t_idx_start + t_val_relative
-
-        p.append(p_val)
-        t.append(t_val)
+    r = np.asarray(r_peaks, dtype=np.int64)
+    if r.size == 0:
+        empty = np.array([], dtype=np.int64)
+        return {'P': empty, 'Q': empty, 'R': r, 'S': empty, 'T': empty}
+
+    n = len(filtered)
+    q_win = int(0.08 * fs)
+    s_win = int(0.08 * fs)
+    p_win = int(0.2 * fs)
+    t_win = int(0.4 * fs)
+
+    if _HAVE_NUMBA:
+        p, q, s, t = _pqrst_numba(np.ascontiguousarray(filtered), r,
+                                  q_win, s_win, p_win, t_win)
+    else:
+        # Q: minimum just before R; S: minimum just after R
+        q = _window_extrema(filtered, np.maximum(0, r - q_win), r, q_win, find_min=True)
+        s = _window_extrema(filtered, r, np.minimum(n, r + s_win), s_win, find_min=True)
+
+        # P: maximum before Q; T: maximum after S. -1 marks beats whose anchor
+        # window was empty (truncated at a record edge).
+        q_ok = q >= 0
+        q_safe = np.where(q_ok, q, 0)
+        p = _window_extrema(filtered, np.maximum(0, q_safe - p_win), q_safe, p_win, find_min=False)
+        p[~q_ok] = -1
+
+        s_ok = s >= 0
+        s_safe = np.where(s_ok, s, 0)
+        t = _window_extrema(filtered, s_safe, np.minimum(n, s_safe + t_win), t_win, find_min=False)
+        t[~s_ok] = -1
 
     return {
-        'P': np.array(p),
-        'Q': np.array(q),
-        'R': np.array(r_peaks),
-        'S': np.array(s),
-        'T': np.array(t)
+        'P': p,
+        'Q': q,
+        'R': r,
+        'S': s,
+        'T': t
     }
 
-info = detect_pqrst(filtered, r_peaks, fs)
-print("PQRST waves detected.")
 
-os.makedirs(output_data, exist_ok=True)
-plot_path = os.path.join(output_data, f"ecg_plot{record_id}.json")
-phases_path = os.path.join(output_data, f"ecg_phases{record_id}.json")
+def _pipeline_one_lead(sig, fs):
+    """Filter, detect and encode a single lead; returns (plot_bytes, phases_bytes)."""
+    filtered = fir_bandpass(sig, fs)
+    logger.debug("ECG signal filtered.")
+
+    # Encode the plot on the pool while R-peak detection and the PQRST pass
+    # run here: the NumPy/scipy work releases the GIL, so the base64/orjson
+    # encode genuinely overlaps it
+    fut_plot = _POOL.submit(_encode_plot, filtered, fs)
+
+    r_peaks = detect_r(filtered, fs)
+    logger.debug("Detected %d R-peaks.", len(r_peaks))
+
+    info = detect_pqrst(filtered, r_peaks, fs)
+    logger.debug("PQRST waves detected.")
+
+    # Columnar phase payload: entry/duration arrays per phase instead of a
+    # list of ~3N dicts. Beats with any window truncated at a record edge
+    # (-1, see detect_pqrst) are dropped so the columns stay beat-aligned.
+    valid = (info['P'] >= 0) & (info['Q'] >= 0) & (info['S'] >= 0) & (info['T'] >= 0)
+    P = (info['P'][valid] / fs).astype(np.float32)
+    Q = (info['Q'][valid] / fs).astype(np.float32)
+    S = (info['S'][valid] / fs).astype(np.float32)
+    T = (info['T'][valid] / fs).astype(np.float32)
+
+    phases = {
+        "PQ": {"entry": P, "duration": Q - P},
+        "QRS": {"entry": Q, "duration": S - Q},
+        "ST": {"entry": S, "duration": T - S},
+    }
+
+    phases_bytes = orjson.dumps(phases, option=orjson.OPT_SERIALIZE_NUMPY,
+                                default=_jsonize)
+    return fut_plot.result(), phases_bytes
 
-with open(plot_path, 'w') as f:
-    json.dump(filtered[:fs * 60].tolist(), f)
-print(f"Plot data saved to {plot_path}")
 
-phases = []
-waves = {w: [i / fs for i in info[w] if i is not None] for w in ['P', 'Q', 'S', 'T']}
+def process(record_id, uploads_dir=UPLOADS_DIR, channels=(0,)):
+    """Run the full ECG pipeline for a record.
+
+    Returns (plot_bytes, phases_bytes) — the two JSON payloads ready to go
+    on the wire. Nothing is written to disk; the CLI entry point persists
+    the payloads itself. Called directly from the Flask handler so each
+    upload reuses the already imported numpy/scipy/wfdb/heartpy instead of
+    paying interpreter startup in a subprocess. Raises on missing files or
+    unreadable records.
+
+    By default only lead 0 is read. Pass an explicit channel list (or None
+    for every lead in the record) to process multiple leads; those payloads
+    come back as JSON arrays with one element per lead, and the leads fan
+    out across cores via joblib when more than one is requested.
+    """
+    logger.debug("Processing record_id: %s in %s", record_id, uploads_dir)
+
+    # Verify all three required files exist
+    required_exts = [".hea", ".dat", ".atr"]
+    for ext in required_exts:
+        file_path = os.path.join(uploads_dir, f"{record_id}{ext}")
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"Missing expected file: {file_path}")
+
+    record_path = os.path.join(uploads_dir, record_id)
+
+    # Optionally cap how much of the .dat is read at all: for long Holter
+    # recordings the header tells us fs up front, so ECG_MAX_SECONDS bounds
+    # sampto and wfdb never materializes samples past the analysis window.
+    # Unset (the default) analyzes the full record.
+    sampto = None
+    max_seconds = os.environ.get('ECG_MAX_SECONDS')
+    if max_seconds:
+        try:
+            header = wfdb.rdheader(record_path)
+            sampto = min(header.sig_len, int(float(max_seconds) * header.fs))
+        except Exception as e:
+            logger.warning("Could not apply ECG_MAX_SECONDS: %s", e)
 
-for i in range(min(len(waves.get('P', [])), len(waves.get('Q', [])), len(waves.get('S', [])), len(waves.get('T', [])))):
     try:
-        if waves['P'][i] is not None and waves['Q'][i] is not None:
-            phases.append({"entry": waves['P'][i], "duration": waves['Q'][i] - waves['P'][i], "phase": "PQ"})
-        if waves['Q'][i] is not None and waves['S'][i] is not None:
-            phases.append({"entry": waves['Q'][i], "duration": waves['S'][i] - waves['Q'][i], "phase": "QRS"})
-        if waves['S'][i] is not None and waves['T'][i] is not None:
-            phases.append({"entry": waves['S'][i], "duration": waves['T'][i] - waves['S'][i], "phase": "ST"})
-    except IndexError:
-        print(f"Warning: Skipping phase calculation for index {i} due to missing wave data.")
-        continue
+        # Read only the requested leads at 32-bit resolution: rdrecord
+        # otherwise loads every channel into a float64 p_signal
+        record = wfdb.rdrecord(record_path,
+                               channels=list(channels) if channels is not None else None,
+                               sampto=sampto, return_res=32)
+        fs = record.fs
+        # copy=False makes this a no-op guard now that wfdb already hands
+        # back float32; it still halves the bytes if return_res is ignored
+        leads = record.p_signal.astype(np.float32, copy=False)
+        logger.debug("Successfully read record: %s, Sampling Frequency: %s", record_id, fs)
     except Exception as e:
-        print(f"Error calculating phases for index {i}: {e}")
-        continue
+        raise RuntimeError(f"Error reading WFDB record {record_id} from {uploads_dir}: {e}") from e
+
+    if leads.shape[1] == 1:
+        plot_bytes, phases_bytes = _pipeline_one_lead(leads[:, 0], fs)
+    else:
+        # Leads hold independent arrays, so multi-lead requests are
+        # embarrassingly parallel across cores
+        if _HAVE_JOBLIB:
+            results = Parallel(n_jobs=leads.shape[1], backend='loky')(
+                delayed(_pipeline_one_lead)(np.ascontiguousarray(sig), fs)
+                for sig in leads.T)
+        else:
+            results = [_pipeline_one_lead(np.ascontiguousarray(sig), fs)
+                       for sig in leads.T]
+        plot_bytes = b'[' + b','.join(r[0] for r in results) + b']'
+        phases_bytes = b'[' + b','.join(r[1] for r in results) + b']'
 
-with open(phases_path, 'w') as f:
-    json.dump(phases, f, indent=2)
-print(f"Phases data saved to {phases_path}")
+    logger.debug("Done processing for record_id: %s.", record_id)
+    return plot_bytes, phases_bytes
 
-print(f"✅ Done processing for record_id: {record_id}. Outputs: {plot_path}, {phases_path}")
\ No newline at end of file
+
+if __name__ == '__main__':
+    # CLI runs keep their chatter on stdout
+    logging.basicConfig(level=os.environ.get('LOGLEVEL', 'INFO'))
+
+    # Ensure record_id is always passed. If not, exit immediately.
+    if len(sys.argv) < 2:
+        print("Error: record_id not provided. Usage: python process_ecg.py <record_id>")
+        sys.exit(1)
+
+    try:
+        plot_out, phases_out = process(sys.argv[1])
+        # Only the CLI workflow persists the payloads; the server returns
+        # them straight from memory
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+        plot_path = os.path.join(OUTPUT_DIR, f"ecg_plot{sys.argv[1]}.json")
+        phases_path = os.path.join(OUTPUT_DIR, f"ecg_phases{sys.argv[1]}.json")
+        with open(plot_path, 'wb') as f:
+            f.write(plot_out)
+        with open(phases_path, 'wb') as f:
+            f.write(phases_out)
+        print(f"Outputs: {plot_path}, {phases_path}")
+    except Exception as e:
+        print(f"Error: {e}")
+        sys.exit(1)